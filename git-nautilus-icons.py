@@ -12,28 +12,49 @@
 from __future__ import print_function, unicode_literals
 import sys
 import os
+import re
 import pathlib
 from enum import IntEnum, unique
-from subprocess import Popen, PIPE, CalledProcessError, check_call
-from collections import defaultdict
+from subprocess import Popen, PIPE, CalledProcessError
+from collections import defaultdict, OrderedDict
 import socket
+import select
 import threading
 import tempfile
+import time
+import json
+import traceback
 from binascii import hexlify
 try:
     from multiprocessing.connection import Connection
 except ImportError:
     from _multiprocessing import Connection
-
-import gi
-from gi.repository import GObject
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 PY2 = sys.version_info.major == 2
 
-# A string in sys.argv so that the worker process can identify itself:
+if PY2:
+    from urlparse import urlparse
+    from urllib import unquote
+else:
+    from urllib.parse import urlparse, unquote
+
+# Strings in sys.argv so that the worker process and the trace replay tool can
+# identify themselves:
 WORKER_ARG = 'git-nautilus-icons-worker'
-if WORKER_ARG not in sys.argv:
-    # Only import the extension modules if we are not the worker process
+REPLAY_ARG = '--replay'
+IS_EXTENSION = WORKER_ARG not in sys.argv and REPLAY_ARG not in sys.argv
+if IS_EXTENSION:
+    # Only import GObject and the extension modules if we are the extension. The worker
+    # has no use for them and they are slow to import.
+    import gi
+    from gi.repository import GObject
     if sys.argv[0] == 'nemo':
         gi.require_version('Nemo', '3.0')
         from gi.repository import Nemo as Nautilus
@@ -66,31 +87,53 @@ BLACKLIST_TEMPLATE = """# git-{nautilus,nemo,caja}-icons blacklist file.
 /home/chrisjbillington/clones/some_other_example_huge_repo.git
 """
 
-# Make blacklist file if it doesn't exist:
 _conf = os.getenv('XDG_CONFIG_HOME', os.path.join(os.getenv('HOME'), '.config'))
 BLACKLIST_FILE = os.path.join(_conf, 'git-nautilus-icons', 'blacklist.conf')
-if not os.path.exists(BLACKLIST_FILE):
-    # Backcompat for before the rename:
-    OLD_BLACKLIST_FILE = os.path.join(_conf, 'git_nautilus_icons', 'blacklist.conf')
-    if os.path.exists(OLD_BLACKLIST_FILE):
-        BLACKLIST_FILE = OLD_BLACKLIST_FILE
-if not os.path.exists(BLACKLIST_FILE):
-    check_call(['mkdir', '-p', os.path.dirname(BLACKLIST_FILE)])
-    with open(BLACKLIST_FILE, 'w') as f:
-        f.write(BLACKLIST_TEMPLATE)
+# Backcompat for before the rename:
+OLD_BLACKLIST_FILE = os.path.join(_conf, 'git_nautilus_icons', 'blacklist.conf')
 
 blacklist = []
 
-with open(BLACKLIST_FILE) as f:
-    for line in f.readlines():
-        line = line.strip()
-        if line and not line.startswith('#'):
-            if not line.endswith('/'):
-                line += '/'
-            blacklist.append(line)
-
 DEBUG = False
 
+# If set, requests for files and the icons given to them are recorded to this file, for
+# replaying with 'python git-nautilus-icons.py --replay <file>' to measure performance:
+TRACE_FILE = os.getenv('GIT_NAUTILUS_ICONS_TRACE')
+
+# If not None, the worker process is restarted between chunks of work once its resident
+# memory exceeds this many megabytes, so that memory used in visiting huge repos is
+# returned to the system in long-running sessions:
+MAX_WORKER_RSS_MB = None
+
+# How many worker processes to run. Requests are sharded between them by repository, so
+# that status calls for one large repository don't hold up icons in other repositories:
+N_WORKERS = 1
+
+
+def load_blacklist():
+    """Read the blacklist file into the module-level blacklist, creating it from the
+    template if it doesn't exist. Only called in the worker process, the parent has no
+    need of the blacklist and we keep its startup as light as possible."""
+    blacklist_file = BLACKLIST_FILE
+    if not os.path.exists(blacklist_file) and os.path.exists(OLD_BLACKLIST_FILE):
+        blacklist_file = OLD_BLACKLIST_FILE
+    if not os.path.exists(blacklist_file):
+        try:
+            os.makedirs(os.path.dirname(blacklist_file))
+        except OSError:
+            # Already exists
+            pass
+        with open(blacklist_file, 'w') as f:
+            f.write(BLACKLIST_TEMPLATE)
+    with open(blacklist_file) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                if not line.endswith('/'):
+                    line += '/'
+                blacklist.append(line)
+
+
 def blacklisted(path):
     path += '/'
     if any(path.startswith(s + '/') for s in blacklist):
@@ -106,6 +149,8 @@ SEND_READY = 0
 STILL_WORKING = 1
 ALL_DONE = 2
 ACK = 4
+RECYCLING = 5
+FORGET = 6
 
 # For printing the above:
 STATUS = {
@@ -113,6 +158,8 @@ STATUS = {
     STILL_WORKING: 'STILL_WORKING',
     ALL_DONE: 'ALL_DONE',
     ACK: 'ACK',
+    RECYCLING: 'RECYCLING',
+    FORGET: 'FORGET',
 }
 
 
@@ -194,7 +241,7 @@ STATUS_CODES = {
 
                 # Some extra ones I'm adding for convenience:
 
-                # When a tracked file listed in 'git ls-tree' is not present
+                # When a tracked file listed in 'git ls-files' is not present
                 # in the output of 'git status -z', then we assume it is
                 # unmodified and use this status:
                 'CLEAN': (IndexStatus.CLEAN, WorktreeStatus.CLEAN, MergeStatus.NO_CONFLICT),
@@ -313,6 +360,18 @@ class NotARepo(CalledProcessError):
     pass
 
 
+class GitCancelled(Exception):
+    """Raised instead of running a git command for a thread whose git budget says its
+    work is no longer wanted"""
+    pass
+
+
+class WorkerUnresponsive(Exception):
+    """Raised in the parent process when the worker has died or has not replied within
+    the timeout"""
+    pass
+
+
 class FileStatuses(dict):
     """Dictionary like object which can lookup the status of a file even if
     only a an ancestor directory is listed as having that status, and not the
@@ -352,13 +411,220 @@ class FileStatuses(dict):
             return STATUS_CODES['ERROR']
 
 
-def git_call(cmd, path):
+class MountTable(object):
+    """Which mount each path is on, and whether that mount is slow, either because it
+    is a network or FUSE filesystem, or because git has been observed to be slow there.
+    Read from /proc/self/mountinfo, so on systems without it all paths are considered to
+    be on one fast mount."""
+    MOUNTINFO = '/proc/self/mountinfo'
+    # How often to re-read the mount table, in seconds:
+    LIFETIME = 5
+    NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'sshfs', 'afs', '9p',
+                           'ceph', 'glusterfs', 'lustre', 'davfs', 'ncpfs', 'coda'}
+    # Mounts on which 'git rev-parse' takes longer than this many seconds on average are
+    # considered slow:
+    SLOW_LATENCY = 0.5
+    # Number of measurements needed before a mount can be considered slow, so that a
+    # single slow command, such as with a cold disk cache, isn't enough:
+    MIN_LATENCY_SAMPLES = 3
+
+    def __init__(self):
+        # (mount point, filesystem type) tuples, longest mount point first:
+        self.mounts = []
+        self.read_time = None
+        # Moving average of 'git rev-parse' durations on each mount point, starting from
+        # zero, and how many there have been:
+        self.latency = {}
+        self.latency_samples = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def read(self):
+        mounts = []
+        try:
+            with open(self.MOUNTINFO) as f:
+                for line in f:
+                    fields = line.split()
+                    # Fields after the optional fields, which end with '-':
+                    fstype = fields[fields.index('-') + 1]
+                    # Spaces etc in the mount point are octal escaped:
+                    mount_point = re.sub(
+                        r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[4]
+                    )
+                    mounts.append((mount_point, fstype))
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+        self.mounts = mounts
+        self.read_time = time.time()
+
+    def get_mount(self, path):
+        """Return the mount point and filesystem type of the mount a path is on"""
+        with self.lock:
+            if self.read_time is None or time.time() - self.read_time > self.LIFETIME:
+                self.read()
+            mounts = self.mounts
+        for mount_point, fstype in mounts:
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                return mount_point, fstype
+        return '/', None
+
+    def record_latency(self, path, duration):
+        mount_point, _ = self.get_mount(path)
+        with self.lock:
+            previous = self.latency.get(mount_point, 0)
+            self.latency[mount_point] = 0.7 * previous + 0.3 * duration
+            self.latency_samples[mount_point] += 1
+
+    def is_slow_fstype(self, fstype):
+        return fstype is not None and (
+            fstype in self.NETWORK_FILESYSTEMS or fstype.split('.')[0] == 'fuse'
+        )
+
+    def is_slow_filesystem(self, path):
+        """Whether a path is on a network or FUSE filesystem"""
+        _, fstype = self.get_mount(path)
+        return self.is_slow_fstype(fstype)
+
+    def is_slow(self, path):
+        """Whether a path is on a network or FUSE filesystem, or on a mount on which git
+        has been observed to be slow"""
+        mount_point, fstype = self.get_mount(path)
+        if self.is_slow_fstype(fstype):
+            return True
+        with self.lock:
+            if self.latency_samples[mount_point] < self.MIN_LATENCY_SAMPLES:
+                return False
+            return self.latency[mount_point] > self.SLOW_LATENCY
+
+
+mounts = MountTable()
+
+
+def function_with_cache(orig_func):
+    """Cache results of a function. The cache is per-thread, and is cleared for the
+    calling thread with func.cache_clear(). Does not support kwargs."""
+    local = threading.local()
+
+    def get_cache():
+        try:
+            return local.cache
+        except AttributeError:
+            local.cache = {}
+            return local.cache
+
+    def f(*args):
+        cache = get_cache()
+        try:
+            return cache[args]
+        except KeyError:
+            cache[(args)] = orig_func(*args)
+            return cache[args]
+    f.get_cache = get_cache
+    f.cache_clear = lambda: get_cache().clear()
+    return f
+
+
+# Maximum number of git commands each of the worker's lanes may run at once:
+MAX_CONCURRENT_GIT = 4
+
+
+class GitBudget(object):
+    """A limit on how many git commands may run at once. Each of the worker's lanes has
+    its own, shared with the helper threads it starts in parallel_map(), so that slow
+    git commands in one lane can't hold up another. If record_latency is False, git
+    commands don't count towards the latency measured for each mount. If cancelled is
+    given, it is called before each git command, and if it returns True, GitCancelled
+    is raised instead of running it. The number of git processes started against the
+    budget is counted in self.processes."""
+    def __init__(self, max_concurrent, record_latency=True, cancelled=None):
+        self.max_concurrent = max_concurrent
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.record_latency = record_latency
+        self.cancelled = cancelled
+        self.processes = 0
+
+    def check_cancelled(self):
+        if self.cancelled is not None and self.cancelled():
+            raise GitCancelled()
+
+
+# The budget of each thread, and the one used by threads that haven't set one:
+thread_git_budget = threading.local()
+default_git_budget = GitBudget(MAX_CONCURRENT_GIT)
+
+
+def use_git_budget(budget):
+    """Make git commands run by the calling thread count against the given budget"""
+    thread_git_budget.budget = budget
+
+
+def get_git_budget():
+    return getattr(thread_git_budget, 'budget', default_git_budget)
+
+# Number of git processes started, as reported by the trace replay tool:
+git_processes_started = 0
+git_processes_lock = threading.Lock()
+
+
+def count_git_process():
+    global git_processes_started
+    budget = get_git_budget()
+    with git_processes_lock:
+        git_processes_started += 1
+        budget.processes += 1
+
+
+def parallel_map(func, items):
+    """Return [func(item) for item in items], with the calls made in as many threads at
+    once as the calling thread's git budget allows git commands. The threads share that
+    budget. If any call raises an exception, it is re-raised in the calling thread."""
+    budget = get_git_budget()
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    indices = iter(range(len(items)))
+    indices_lock = threading.Lock()
+
+    def run():
+        use_git_budget(budget)
+        while True:
+            with indices_lock:
+                i = next(indices, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as e:
+                errors.append(e)
+
+    n_threads = min(len(items), budget.max_concurrent)
+    threads = [threading.Thread(target=run) for _ in range(n_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def git_call(cmd, path, record_latency=False):
     """Calls a command with check_output, raising NotARepo if there is no git
     repo there. This lets us avoid the race condition of a repo disappearing
-    disappear before we call the command."""
+    disappear before we call the command. Waits if the calling thread's git budget
+    is used up. If record_latency is True, how long the command took is recorded against
+    the mount the path is on."""
+    budget = get_git_budget()
     try:
-        proc = Popen(cmd, cwd=path, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = proc.communicate()
+        with budget.semaphore:
+            budget.check_cancelled()
+            start_time = time.time()
+            count_git_process()
+            proc = Popen(cmd, cwd=path, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = proc.communicate()
+            if record_latency and budget.record_latency and not proc.returncode:
+                mounts.record_latency(path, time.time() - start_time)
     except OSError:
         # Git not installed, or repo path doesn't exist or isn't a directory.
         raise NotARepo(1, cmd, "Couldn't run git command - path might not exist")
@@ -369,6 +635,59 @@ def git_call(cmd, path):
     return stdout.decode('utf8')
 
 
+def git_stream(cmd, path):
+    """Generator version of git_call() for commands with NUL-separated output, yielding
+    each entry as bytes as soon as git outputs it, so that the output needn't be held in
+    memory and callers can stop reading early. If they do, git is killed. Raises
+    NotARepo if git fails."""
+    budget = get_git_budget()
+    with budget.semaphore:
+        budget.check_cancelled()
+        count_git_process()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                proc = Popen(cmd, cwd=path, stdout=PIPE, stderr=devnull)
+        except OSError:
+            # Git not installed, or repo path doesn't exist or isn't a directory.
+            raise NotARepo(1, cmd, "Couldn't run git command - path might not exist")
+        finished = False
+        try:
+            buffer = b''
+            while True:
+                data = os.read(proc.stdout.fileno(), 65536)
+                if not data:
+                    break
+                entries = (buffer + data).split(b'\x00')
+                buffer = entries.pop()
+                for entry in entries:
+                    yield entry
+            finished = True
+        finally:
+            if not finished:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+    if proc.returncode:
+        raise NotARepo(proc.returncode, cmd, output=b'')
+
+
+@function_with_cache
+def scan_directory(path):
+    """Returns a list of (fullname, is_dir) tuples for the entries of a directory, or an
+    empty list if it has been deleted, unmounted, or otherwise can't be read. Uses the
+    file type returned with the directory listing where possible rather than a stat
+    call per entry. Symlinks to directories count as directories, as with
+    os.path.isdir()"""
+    try:
+        if scandir is None:
+            return [(os.path.join(path, basename), os.path.isdir(os.path.join(path, basename)))
+                    for basename in os.listdir(path)]
+        return [(entry.path, entry.is_dir()) for entry in scandir(path)]
+    except (OSError, IOError):
+        return []
+
+
+@function_with_cache
 def is_git_repo(path):
     """returns whether a path is a git repo"""
     if blacklisted(path):
@@ -376,34 +695,240 @@ def is_git_repo(path):
     return os.path.isdir(os.path.join(path, '.git'))
 
 
+def in_same_repo_as_parent(path):
+    """Returns whether a directory is in the same repo as its parent, if its parent is
+    in one, without calling git: it is not a repo itself, the .git directory, a symlink
+    to somewhere else, or on a different mount"""
+    return (
+        os.path.basename(path) != '.git'
+        and not is_git_repo(path)
+        and not os.path.islink(path)
+        and mounts.get_mount(path) == mounts.get_mount(os.path.dirname(path))
+    )
+
+
+@function_with_cache
 def is_in_work_tree(path):
     """returns whether a path is in the work tree of a git repo (ie, not
     inside .git!)"""
     if blacklisted(path):
         return False
+    if is_git_repo(path):
+        # The root of a repo, no need to ask git:
+        return True
+    parent_cached = is_in_work_tree.get_cache().get((os.path.dirname(path),))
+    if parent_cached and in_same_repo_as_parent(path):
+        # A subdirectory of a directory we already asked git about:
+        return True
     cmd = ['git', 'rev-parse', '--is-inside-work-tree']
     try:
-        return git_call(cmd, path).strip() == 'true'
+        return git_call(cmd, path, record_latency=True).strip() == 'true'
     except NotARepo:
         return False
 
 
+def find_enclosing_repo(directory):
+    """Return the root of the repository containing a directory, or None if it is not
+    in one. Found by looking for '.git' in the directory and its parents, without
+    calling git."""
+    root = directory
+    while not os.path.exists(os.path.join(root, '.git')):
+        parent = os.path.dirname(root)
+        if parent == root:
+            return None
+        root = parent
+    return root
+
+
+@function_with_cache
 def get_repo_root(path):
     """Returns the root directory of a repo, given a directory within it,
     or raises NotARepo if the directory is not in a git repo"""
     if blacklisted(path):
         raise NotARepo
+    if is_git_repo(path):
+        # The root of a repo, no need to ask git:
+        return os.path.normpath(path)
+    parent_cached = get_repo_root.get_cache().get((os.path.dirname(path),))
+    if parent_cached is not None and in_same_repo_as_parent(path):
+        # A subdirectory of a directory we already asked git about:
+        return parent_cached
     cmd = ['git', 'rev-parse', '--show-cdup']
-    output = git_call(cmd, path).strip()
+    output = git_call(cmd, path, record_latency=True).strip()
     return os.path.normpath(os.path.join(path, output))
 
 
+@function_with_cache
+def get_git_dirs(repo_root):
+    """Return the git directory of the repo with the given root, and the common git
+    directory it shares with any other worktrees of the same repo, without running
+    git"""
+    git_dir = os.path.join(repo_root, '.git')
+    if os.path.isfile(git_dir):
+        # A submodule or additional worktree, .git is a file saying where the git
+        # directory is:
+        try:
+            with open(git_dir) as f:
+                git_dir = os.path.join(repo_root, f.read().strip()[len('gitdir: '):])
+        except (OSError, IOError):
+            pass
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except (OSError, IOError):
+        pass
+    return git_dir, common_dir
+
+
+def is_partial_clone(repo_root):
+    """Returns whether the repo is a partial clone, which fetches objects it does not
+    have from the remote when they are needed. Partial clones always have at least one
+    promisor pack"""
+    _, common_dir = get_git_dirs(repo_root)
+    try:
+        pack_names = os.listdir(os.path.join(common_dir, 'objects', 'pack'))
+    except OSError:
+        return False
+    return any(name.endswith('.promisor') for name in pack_names)
+
+
+def is_sparse_checkout(repo_root):
+    """Returns whether the repo's work tree may be a sparse checkout, in which files
+    outside the sparse checkout patterns are not on disk. The patterns file is left
+    behind if sparse checkout is disabled, but nothing is lost by treating such a repo
+    as sparse"""
+    git_dir, _ = get_git_dirs(repo_root)
+    return os.path.isfile(os.path.join(git_dir, 'info', 'sparse-checkout'))
+
+
+def status_command(repo_root, *args):
+    """Returns the 'git status -z' command to run in a repo, with any additional
+    arguments"""
+    cmd = ['git', 'status', '-z'] + list(args)
+    if is_partial_clone(repo_root):
+        # Detecting renames may need the contents of deleted files, which a partial
+        # clone would fetch from the remote. Show staged renames as a deletion and an
+        # addition instead:
+        cmd.append('--no-renames')
+    return cmd
+
+
 def repo_is_ahead(path):
     """Returns whether the repo at a given path has any unpushed commits"""
     cmd = ['git', 'for-each-ref', '--format="%(push:track)"', 'refs/heads']
     return 'ahead' in git_call(cmd, path)
 
 
+class CheckIgnore(object):
+    """A persistent 'git check-ignore' process for a repo, to which paths can be sent in
+    bulk to find out which are ignored. This only costs as much as the paths asked
+    about, whereas 'git status --ignored' would walk the entirety of ignored
+    directories."""
+    # git check-ignore reads each .gitignore file only once, so restart the process
+    # after this many seconds to pick up changes to them:
+    LIFETIME = 10
+    # Paths are sent in batches no bigger than this, and the results read before the
+    # next batch is sent, so that neither process can fill the pipe to the other and
+    # block while the other is waiting on it:
+    MAX_BATCH = 64
+    MAX_BATCH_BYTES = 8192
+
+    def __init__(self, repo_root):
+        self.repo_root = repo_root
+        cmd = ['git', 'check-ignore', '--stdin', '-z', '--verbose', '--non-matching']
+        env = dict(os.environ, GIT_FLUSH='1')
+        count_git_process()
+        with open(os.devnull, 'w') as devnull:
+            self.proc = Popen(
+                cmd, cwd=repo_root, stdin=PIPE, stdout=PIPE, stderr=devnull, env=env
+            )
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.buffer = b''
+
+    def expired(self):
+        return time.time() - self.start_time > self.LIFETIME or self.proc.poll() is not None
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+    def read_fields(self, n):
+        """Read n NUL-terminated fields from the process's output"""
+        while self.buffer.count(b'\x00') < n:
+            data = os.read(self.proc.stdout.fileno(), 65536)
+            if not data:
+                raise IOError('git check-ignore exited')
+            self.buffer += data
+        fields = self.buffer.split(b'\x00', n)
+        self.buffer = fields.pop()
+        return fields
+
+    def check(self, paths):
+        """Return the set of the given paths that are ignored"""
+        ignored = set()
+        with self.lock:
+            i = 0
+            while i < len(paths):
+                batch = []
+                data = b''
+                while (i < len(paths) and len(batch) < self.MAX_BATCH
+                       and len(data) < self.MAX_BATCH_BYTES):
+                    relpath = os.path.relpath(paths[i], self.repo_root)
+                    data += (relpath.encode('utf8') if PY2 else os.fsencode(relpath)) + b'\x00'
+                    batch.append(paths[i])
+                    i += 1
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+                # Each path gets four fields: source, line number, pattern and path. The
+                # first three are empty if the path matches no pattern, and a pattern
+                # beginning with '!' means the path is explicitly not ignored:
+                fields = self.read_fields(4 * len(batch))
+                for j, path in enumerate(batch):
+                    pattern = fields[4 * j + 2]
+                    if pattern and not pattern.startswith(b'!'):
+                        ignored.add(path)
+        return ignored
+
+
+# Running CheckIgnore processes, least recently used first:
+check_ignore_processes = OrderedDict()
+check_ignore_lock = threading.Lock()
+MAX_CHECK_IGNORE_PROCESSES = 8
+
+
+def get_ignored(repo_root, paths):
+    """Return the set of the given paths, all of which must be within the given repo,
+    that are ignored by git"""
+    if not paths:
+        return set()
+    with check_ignore_lock:
+        check_ignore = check_ignore_processes.pop(repo_root, None)
+        if check_ignore is None or check_ignore.expired():
+            if check_ignore is not None:
+                check_ignore.close()
+            try:
+                check_ignore = CheckIgnore(repo_root)
+            except OSError:
+                # Git not installed, or repo path doesn't exist
+                return set()
+        check_ignore_processes[repo_root] = check_ignore
+        while len(check_ignore_processes) > MAX_CHECK_IGNORE_PROCESSES:
+            _, oldest = check_ignore_processes.popitem(last=False)
+            oldest.close()
+    try:
+        return check_ignore.check(paths)
+    except (IOError, OSError, ValueError):
+        # Repo deleted or the process otherwise died. Treat nothing as ignored:
+        with check_ignore_lock:
+            if check_ignore_processes.get(repo_root) is check_ignore:
+                del check_ignore_processes[repo_root]
+        check_ignore.close()
+        return set()
+
+
 def get_folder_overall_status(path, file_statuses, all_statuses):
     """Returns a 3-tuple of an IndexStatus, WorktreeStatus and MergeStatus,
     chosen based on the most severe of the corresponding statuses of the
@@ -424,10 +949,7 @@ def get_repo_overall_status(path, statuses):
     """Return the repo's overall status, 5-tuple of a SyncStatus, RepoStatus,
     IndexStatus, WorktreeStatus and MergeStatus. The latter three are chosen
     based on the most severe of the corresponding statuses of the files"""
-    if repo_is_ahead(path):
-        sync_status = SyncStatus.AHEAD
-    else:
-        sync_status = SyncStatus.NOT_AHEAD
+    sync_status = SyncStatus.AHEAD if repo_is_ahead(path) else SyncStatus.NOT_AHEAD
     repo_status = RepoStatus.IS_A_REPO
     if not statuses:
         # No files! Therefore clean.
@@ -441,31 +963,44 @@ def get_repo_overall_status(path, statuses):
     return sync_status, repo_status, index_status, worktree_status, merge_status
 
 
-def function_with_cache(orig_func):
-    """Cache results of a function clear cache with func.cache.clear. Does not support
-    kwargs."""
-    def f(*args):
+def index_entries(repo_root):
+    """Generator of the entries of 'git ls-files -z -t' for a repo, as bytes. Each is a
+    one letter tag, a space, and a path relative to the repo root. Files outside a
+    sparse checkout have the tag 'S'. Unlike listing the files in HEAD, this reads no
+    objects that a partial clone might have to fetch."""
+    cmd = ['git', 'ls-files', '-z', '-t']
+    if is_sparse_checkout(repo_root):
+        # With a sparse index, list each directory outside the sparse checkout as a
+        # single entry instead of expanding the index to list all their files:
+        started = False
         try:
-            return f.cache[args]
-        except KeyError:
-            f.cache[(args)] = orig_func(*args)
-            return f.cache[args]
-    f.cache = {}
-    return f
+            for entry in git_stream(cmd + ['--sparse'], repo_root):
+                started = True
+                yield entry
+            return
+        except NotARepo:
+            if started:
+                raise
+            # Git older than 2.35, without --sparse.
+    for entry in git_stream(cmd, repo_root):
+        yield entry
 
 
-@function_with_cache
 def repo_status(path):
+    """Return the status of the repo containing a path overall as well as a dict
+    of the statuses of all non-ignored files in it. All files within the work
+    tree but not listed in the output have the status of their parent
+    directories. Raises NotARepo if the path no longer points to a git repo.
+    Cached by repo, so that directories in the same repo share one status."""
+    return repo_root_status(get_repo_root(path))
+
+
+@function_with_cache
+def repo_root_status(repo_root):
     if DEBUG:
-        print("repo status:", path)
-    """Return the status of the repo overall as well as a dict of the statuses
-    of all non-ignored files in it. All files within the work tree but not
-    listed in the output have the status of their parent directories.
-    Raises NotARepo if the path no longer points to a git repo."""
-    repo_root = get_repo_root(path)
+        print("repo status:", repo_root)
     # 'git status' will get all files other than unmodified ones:
-    status_command = ['git', 'status', '-z']
-    status_output = git_call(status_command, path)
+    status_output = git_call(status_command(repo_root), repo_root)
     statuses = FileStatuses(repo_root)
     status_entries = status_output.split('\x00')[:-1]
     i = 0
@@ -495,24 +1030,136 @@ def repo_status(path):
             # A rename, the next entry is the original filename. Skip it.
             i += 1
         i += 1
-    # And now to get all the unmodified files:
-    lstree_command = ['git', 'ls-tree', '--full-tree', '-zr', '--name-only', 'HEAD']
-    try:
-        lstree_output = git_call(lstree_command, path)
-    except CalledProcessError as e:
-        if not 'Not a valid object name HEAD' in e.output.decode('utf8'):
-            # Ignore if there is no HEAD (no commits probably). Otherwise raise.
-            raise
-    else:
-        lstree_entries = set(lstree_output.split('\x00')[:-1])
-        for lstree_relpath in lstree_entries:
-            filename = os.path.join(repo_root, lstree_relpath)
-            if filename not in statuses:
-                statuses[filename] = STATUS_CODES['CLEAN']
-    overall_status = get_repo_overall_status(path, statuses)
+    # And now to get all the unmodified files. These are the files in the index not
+    # listed by 'git status', which lists all files in only one of the index and HEAD.
+    # Files outside a sparse checkout are skipped:
+    for lsfiles_entry in index_entries(repo_root):
+        lsfiles_entry = lsfiles_entry.decode('utf8')
+        if lsfiles_entry[0] == 'S':
+            continue
+        filename = os.path.join(repo_root, lsfiles_entry[2:])
+        if filename not in statuses:
+            statuses[filename] = STATUS_CODES['CLEAN']
+    overall_status = get_repo_overall_status(repo_root, statuses)
     return overall_status, statuses
 
 
+# Once a repo has a file that is unmerged and modified on both sides, no other file can
+# change the icon it is shown with:
+DECISIVE_STATUS = (WorktreeStatus.UNMERGED, MergeStatus.BOTH_MODIFIED)
+
+
+@function_with_cache
+def repo_summary(path):
+    """Return the overall status of the repo at path, for showing it as a single icon.
+    This gives the same icon as the overall status returned by repo_status(), but is
+    cheaper for large repos: the output of 'git status' is read as it is produced
+    without being stored, git is stopped as soon as the icon is decided, and the
+    files in the index are only listed if needed, and only until the first one.
+    Raises NotARepo if the path no longer points to a git repo."""
+    index_status = IndexStatus.NOT_IN_INDEX
+    worktree_status = WorktreeStatus.CLEAN
+    merge_status = MergeStatus.NO_CONFLICT
+    any_entries = False
+    skip_next = False
+    for entry in git_stream(status_command(path), path):
+        if skip_next:
+            # The original name of a renamed file.
+            skip_next = False
+            continue
+        # Type changes and copies are treated as in repo_root_status():
+        status = entry[0:2].decode('utf8').replace('T', 'M').replace('C', 'A')
+        skip_next = status[0] == 'R'
+        any_entries = True
+        index, worktree, merge = STATUS_CODES[status]
+        index_status = max(index_status, index)
+        worktree_status = max(worktree_status, worktree)
+        merge_status = max(merge_status, merge)
+        if (worktree_status, merge_status) == DECISIVE_STATUS:
+            break
+    if not any_entries:
+        # Nothing changed or untracked, therefore clean.
+        index_status = IndexStatus.CLEAN
+    elif index_status < IndexStatus.CLEAN:
+        # Only untracked files. repo_status() would give every file in the index a
+        # clean status, since none are listed by 'git status', so the index status is
+        # clean if there are any, other than those outside a sparse checkout:
+        if any(not entry.startswith(b'S ') for entry in index_entries(path)):
+            index_status = IndexStatus.CLEAN
+    sync_status = SyncStatus.AHEAD if repo_is_ahead(path) else SyncStatus.NOT_AHEAD
+    return sync_status, RepoStatus.IS_A_REPO, index_status, worktree_status, merge_status
+
+
+def clear_caches():
+    """Clear the calling thread's cached results of git commands and filesystem
+    reads"""
+    get_repo_root.cache_clear()
+    is_in_work_tree.cache_clear()
+    repo_root_status.cache_clear()
+    repo_summary.cache_clear()
+    directory_status.cache_clear()
+    scan_directory.cache_clear()
+    is_git_repo.cache_clear()
+    get_git_dirs.cache_clear()
+
+
+# Cached results of git commands that the worker's prefetcher reuses from its fast lane,
+# rather than running the same commands again straight afterwards:
+SHARED_CACHES = [is_in_work_tree, get_repo_root, repo_root_status, repo_summary]
+
+
+# Files in a repo's git directory that change whenever anything is staged or committed,
+# or another branch is checked out:
+GIT_STATE_FILES = ['index', 'HEAD', os.path.join('logs', 'HEAD')]
+
+
+def git_state_modified_since(repo_root, t):
+    """Returns whether a repo's index or HEAD might have changed since time t, judging
+    by modification times. Modification times may be as coarse as one second, so
+    anything modified within a second before t counts as modified since."""
+    git_dir, _ = get_git_dirs(repo_root)
+    for name in GIT_STATE_FILES:
+        try:
+            if os.stat(os.path.join(git_dir, name)).st_mtime >= t - 1:
+                return True
+        except OSError:
+            # No reflog, or repo deleted, in which case the directory has changed too.
+            pass
+    return False
+
+
+def modified_since(path, t):
+    """Returns whether the statuses of a directory might have changed since time t,
+    judging by the modification times of the directory, the files and directories in it,
+    and the index and HEAD of the repo it is in or of any repos in it. Changes deeper
+    within its subdirectories are not noticed."""
+    try:
+        names = [name for name in os.listdir(path) if name != '.git']
+    except OSError:
+        return True
+    paths = [path] + [os.path.join(path, name) for name in names]
+    for fullname in paths:
+        try:
+            if os.lstat(fullname).st_mtime >= t - 1:
+                return True
+        except OSError:
+            # Deleted since we listed it:
+            return True
+    repo_roots = [fullname for fullname in paths[1:] if is_git_repo(fullname)]
+    enclosing_repo = find_enclosing_repo(path)
+    if enclosing_repo is not None:
+        repo_roots.append(enclosing_repo)
+    return any(git_state_modified_since(root, t) for root in repo_roots)
+
+
+def try_repo_summary(path):
+    """Return repo_summary(path), or None if it is not a repo"""
+    try:
+        return repo_summary(path)
+    except NotARepo:
+        return None
+
+
 def get_statuses_by_dir(path, file_statuses):
     """Sort the file statuses into which directory at the current level they
     are under. Only keep unique statuses, and return a dictionary of sets for
@@ -529,7 +1176,7 @@ def get_statuses_by_dir(path, file_statuses):
 
 
 @function_with_cache
-def directory_status(path):
+def directory_status(path, slow=False):
     if DEBUG:
         print("directory_status:", path)
     """Returns the statuses for all the files/directories in a given path
@@ -541,22 +1188,36 @@ def directory_status(path):
     calculated as if the repo contained a file with the status of the
     submodule itself. Thus, if a submodule is itself clean, but is checked out
     at a different commit than recorded by a commit in the parent repo, then
-    it will appear as modified."""
+    it will appear as modified. Repos in a directory outside any repo are
+    only given statuses if whether they are on a slow filesystem matches
+    slow, so that a repo that is a network mount in a local directory is
+    processed in the slow lane, and doesn't hold up the others."""
     if path.endswith(ICON_TESTING_DIR):
         return example_statuses(path)
     statuses = {}
     if not is_in_work_tree(path):
         # Not in a git repo. Give statuses of any git repos within:
-        try:
-            subdirs = os.listdir(path)
-        except (OSError,FileNotFoundError):
-            # Deleted, unmounted, or otherwise gone
-            subdirs = []
-        for basename in subdirs:
-            fullname = os.path.join(path, basename)
-            if os.path.isdir(fullname) and is_git_repo(fullname):
+        entries = scan_directory(path)
+        path_is_slow = mounts.is_slow(path)
+        # Check whether entries are slow first, so that we don't look for '.git' in
+        # slow ones from the fast lane:
+        repos = set(
+            fullname for fullname, is_dir in entries
+            if is_dir and (path_is_slow or mounts.is_slow(fullname)) == slow
+            and is_git_repo(fullname)
+        )
+        # Get the statuses of repos not already cached concurrently, and cache them for
+        # this thread. Each repo is shown with a single icon, so only a summary of its
+        # status is needed:
+        cache = repo_summary.get_cache()
+        uncached = [fullname for fullname in repos if (fullname,) not in cache]
+        for fullname, result in zip(uncached, parallel_map(try_repo_summary, uncached)):
+            if result is not None:
+                cache[(fullname,)] = result
+        for fullname, is_dir in entries:
+            if fullname in repos:
                 try:
-                    status, _ = repo_status(fullname)
+                    status = repo_summary(fullname)
                 except NotARepo:
                     # Repo deleted
                     continue
@@ -573,16 +1234,23 @@ def directory_status(path):
         # As an optimisation, collect the set of statuses in each directory at
         # the current level we're at:
         statuses_by_dir = get_statuses_by_dir(path, file_statuses)
-        try:
-            subdirs = os.listdir(path)
-        except (OSError,FileNotFoundError):
-            # Deleted, unmounted, or otherwise gone
-            subdirs = []
-        for basename in subdirs:
-            fullname = os.path.join(path, basename)
-            if basename == '.git':
+        entries = scan_directory(path)
+        # Anything git status and ls-files told us nothing about might be ignored. Ask
+        # git about all of them at once:
+        ignored = get_ignored(file_statuses.repo_root, [
+            fullname for fullname, is_dir in entries
+            if fullname not in file_statuses
+            and fullname + '/' not in file_statuses
+            and fullname not in statuses_by_dir
+            and os.path.basename(fullname) != '.git'
+            and not (is_dir and is_git_repo(fullname))
+        ])
+        for fullname, is_dir in entries:
+            if os.path.basename(fullname) == '.git':
                 status = STATUS_CODES['IS_DOT_GIT']
-            elif not os.path.isdir(fullname):
+            elif fullname in ignored:
+                status = STATUS_CODES['!!']
+            elif not is_dir:
                 # A normal file:
                 status = file_statuses.get_status(fullname)
             elif is_git_repo(fullname):
@@ -610,13 +1278,6 @@ def directory_status(path):
 def get_filepath(file):
     """Extract filepath from the URI in a NautilusVFSFile object. Return the
     filepath or None if uri scheme is not 'file'"""
-    if sys.version_info.major == 2:
-        from urlparse import urlparse
-        from urllib import unquote
-    else:
-        from urllib.parse import urlparse
-        from urllib.parse import unquote
-
     def _checkdecode(s):
         return s.decode('utf8') if isinstance(s, bytes) else s
 
@@ -627,8 +1288,50 @@ def get_filepath(file):
         return os.path.abspath(os.path.join(netloc, path))
 
 
+def get_rss():
+    """Return the resident set size of the current process in bytes, or None if it
+    can't be determined"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class Lane(object):
+    """Files waiting to be processed by one of the worker's git status threads. Files
+    on slow filesystems get a lane of their own, so that they don't hold up the rest."""
+    def __init__(self, name, cache_lifetime):
+        self.name = name
+        # Files whose status we still need to check
+        self.pending = set()
+        self.processing_required = threading.Event()
+        # How long, in seconds, results may be cached for across chunks:
+        self.cache_lifetime = cache_lifetime
+        self.cache_time = None
+        self.git_budget = GitBudget(MAX_CONCURRENT_GIT)
+
+
 class WorkerProcess(object):
+    # Time to wait for more files before processing a batch. This is the initial value,
+    # after which it adapts to the rate files arrive at, between the given bounds:
     TIMEOUT = 0.01
+    MIN_TIMEOUT = 0.002
+    MAX_TIMEOUT = 0.05
+    # How long, in seconds, git statuses on network and FUSE filesystems are reused for
+    # before being recomputed:
+    SLOW_CACHE_LIFETIME = 60
+    # How long, in seconds, to wait after the last request before prefetching:
+    PREFETCH_DELAY = 1
+    # Maximum number of directories to prefetch at a time:
+    MAX_PREFETCH = 32
+    # Maximum number of git processes to start each time we prefetch:
+    MAX_PREFETCH_GIT = 32
+    # How long, in seconds, prefetched statuses may be used for. Changes deep within
+    # subdirectories aren't noticed when checking whether they are still valid:
+    PREFETCH_LIFETIME = 30
+    # Number of recently viewed directories to remember for prefetching:
+    MAX_RECENT = 16
     """A separate process for making git status calls without blocking Nautilis's GUI.
     This could have been a thread instead of a process, but nautilus-python has an issue
     where it does not realease the GIL when it has finished running extension code, so
@@ -636,51 +1339,291 @@ class WorkerProcess(object):
     separate process instead."""
     def __init__(self, conn):
         self.conn = conn
-        # Files whose status we still need to check
-        self.pending = set()
-        # Files whose status we're waiting to send to the parent process
-        self.ready = set()
+        self.fast_lane = Lane('fast', cache_lifetime=0)
+        self.slow_lane = Lane('slow', cache_lifetime=self.SLOW_CACHE_LIFETIME)
+        # Files whose icons have changed since we last told the parent about them, and
+        # that we're waiting to send. Dict of path: icon, where an icon of None means the
+        # file should have no icon:
+        self.ready = {}
+        # The icon we last told the parent about for each file:
+        self.reported = {}
+        # How many files we have processed, so that the parent can tell we're making
+        # progress even when no icons have changed:
+        self.processed = 0
+        # Repository roots we have found that we haven't told the parent about yet, and
+        # those we have. The parent uses them to shard requests between workers:
+        self.new_roots = set()
+        self.reported_roots = set()
         self.lock = threading.Lock()
-        self.processing_required = threading.Event()
-        self.git_status_loop_thread = threading.Thread(target=self.git_status_loop)
-        self.git_status_loop_thread.daemon = True
-        self.git_status_loop_thread.start()
-
-    def git_status_loop(self):
-        """Runs in a thread to get git statuses for files in self.pending, and add them
-        to self.ready. Does work until self.pending is empty, and then blocks until
-        self.processing_required is set."""
+        # Set when we have exceeded MAX_WORKER_RSS_MB and should exit once idle:
+        self.recycle = False
+        # Directories recently viewed, least recent first:
+        self.recent = OrderedDict()
+        self.last_request_time = time.time()
+        # Moving average of the time between files arriving in a batch:
+        self.mean_interval = self.TIMEOUT / 3
+        self.prefetch_required = threading.Event()
+        # Statuses of directories we have prefetched, as dirname: (time, statuses):
+        self.prefetched = {}
+        # The fast lane's cached results from its last chunk of work, and the time it
+        # started them, for the prefetcher to reuse:
+        self.lane_caches = None
+        # Our own budget, so that we never hold up the lanes' git commands. Our niced
+        # git commands are not representative of how fast each mount is:
+        self.prefetch_budget = GitBudget(
+            1, record_latency=False, cancelled=self.prefetch_cancelled
+        )
+        # How many git processes the prefetcher had started when it last began:
+        self.prefetch_round_start = 0
+        for lane in [self.fast_lane, self.slow_lane]:
+            thread = threading.Thread(target=self.git_status_loop, args=(lane,))
+            thread.daemon = True
+            thread.start()
+        self.prefetch_loop_thread = threading.Thread(target=self.prefetch_loop)
+        self.prefetch_loop_thread.daemon = True
+        self.prefetch_loop_thread.start()
+
+    @property
+    def pending(self):
+        return self.fast_lane.pending or self.slow_lane.pending
+
+    def get_lane(self, path):
+        # The path itself may be the mount point of a slow filesystem, such as a repo
+        # mounted over the network in a local directory:
+        if mounts.is_slow(os.path.dirname(path)) or mounts.is_slow(path):
+            return self.slow_lane
+        return self.fast_lane
+
+    def on_slow_filesystem(self, path):
+        return (
+            mounts.is_slow_filesystem(os.path.dirname(path))
+            or mounts.is_slow_filesystem(path)
+        )
+
+    def git_status_loop(self, lane):
+        """Runs in a thread to get git statuses for files in lane.pending, and add them
+        to self.ready if their icons have changed since last reported. Does work until
+        lane.pending is empty, and then blocks until lane.processing_required is set."""
+        use_git_budget(lane.git_budget)
         while True:
-            self.processing_required.wait()
+            lane.processing_required.wait()
             if DEBUG:
-                print("worker: git status loop: triggered")
-            self.processing_required.clear()
-            while self.pending:
+                print("worker: git status loop: triggered:", lane.name)
+            lane.processing_required.clear()
+            did_work = bool(lane.pending)
+            while lane.pending:
                 # We process in a chunk so that we can cache git status calls and
                 # directory status calls within a chunk, but that new files arriving in
-                # the meantime will not use the cache, as it might be invalid by then.
-                repo_status.cache.clear()
-                directory_status.cache.clear()
-                pending = self.pending.copy()
+                # the meantime will not use the cache, as it might be invalid by then,
+                # unless the lane allows results to be cached for longer.
+                now = time.time()
+                pending = lane.pending.copy()
+                cache_lifetime = lane.cache_lifetime
+                if cache_lifetime and not all(
+                    self.on_slow_filesystem(path) for path in pending
+                ):
+                    # Only network and FUSE filesystems are always slow. Others measured
+                    # as slow may only have been briefly, so we don't risk showing
+                    # out of date icons for them:
+                    cache_lifetime = 0
+                if lane.cache_time is None or now - lane.cache_time >= cache_lifetime:
+                    clear_caches()
+                    lane.cache_time = now
+                # Statuses of the directories in this chunk:
+                dir_statuses = {}
                 while pending:
                     path = pending.pop()
-                    status = directory_status(os.path.dirname(path)).get(path, None)
-                    if status is not None:
-                        icon = get_icon(status)
-                        if icon is not None:
-                            with self.lock:
-                                if DEBUG:
-                                    print('adding to ready set:', path)
-                                self.ready.add((path, icon))
-                    self.pending.remove(path)
+                    dirname = os.path.dirname(path)
+                    if dirname not in dir_statuses:
+                        statuses = None
+                        if lane is self.fast_lane:
+                            statuses = self.pop_prefetched(dirname)
+                        try:
+                            if statuses is None:
+                                statuses = directory_status(dirname, lane is self.slow_lane)
+                        except Exception:
+                            # Don't let one bad directory stop the lane. Its files just
+                            # get no icons:
+                            sys.stderr.write(
+                                "git-nautilus-icons: error getting statuses in %s:\n%s"
+                                % (dirname, traceback.format_exc())
+                            )
+                            statuses = {}
+                        dir_statuses[dirname] = statuses
+                        if N_WORKERS > 1:
+                            self.found_root(find_enclosing_repo(dirname))
+                    status = dir_statuses[dirname].get(path, None)
+                    if N_WORKERS > 1 and status is not None and len(status) == 5:
+                        # A repo:
+                        self.found_root(path)
+                    icon = get_icon(status) if status is not None else None
+                    with self.lock:
+                        if path not in self.reported or self.reported[path] != icon:
+                            if DEBUG:
+                                print('adding to ready set:', path)
+                            self.ready[path] = icon
+                            self.reported[path] = icon
+                        self.processed += 1
+                    lane.pending.remove(path)
+                if MAX_WORKER_RSS_MB is not None and not self.recycle:
+                    rss = get_rss()
+                    if rss is not None and rss > MAX_WORKER_RSS_MB * 1024 * 1024:
+                        if DEBUG:
+                            print('worker: RSS %d MB exceeds limit' % (rss // 1024**2))
+                        self.recycle = True
+                if lane is self.fast_lane:
+                    with self.lock:
+                        self.lane_caches = lane.cache_time, dict(
+                            (func, dict(func.get_cache())) for func in SHARED_CACHES
+                        )
+            if did_work:
+                self.prefetch_required.set()
+
+    def pop_prefetched(self, dirname):
+        """Return the statuses prefetched for a directory, or None if there are none
+        that are still valid. They are used only once, so that viewing the directory
+        again, such as by pressing F5, gets fresh statuses."""
+        with self.lock:
+            prefetched = self.prefetched.pop(dirname, None)
+        if prefetched is None or not self.prefetch_valid(dirname, prefetched[0]):
+            return None
+        if DEBUG:
+            print('worker: using prefetched statuses:', dirname)
+        return prefetched[1]
+
+    def prefetch_valid(self, dirname, prefetch_time):
+        return (
+            time.time() - prefetch_time < self.PREFETCH_LIFETIME
+            and not modified_since(dirname, prefetch_time)
+        )
+
+    def found_root(self, root):
+        """Record a repository root to be reported to the parent, if we haven't
+        already"""
+        if root is not None:
+            with self.lock:
+                if root not in self.reported_roots:
+                    self.new_roots.add(root)
+
+    def get_prefetch_candidates(self):
+        """Return directories the user is likely to view next, most likely first: the
+        subdirectories of the directory they are viewing, its parent, any repos that
+        are siblings of the repo it is in, and other recently viewed directories."""
+        with self.lock:
+            recent = list(reversed(self.recent))
+        if not recent:
+            return []
+        current = recent[0]
+        candidates = [
+            fullname for fullname, is_dir in scan_directory(current)
+            if is_dir and os.path.basename(fullname) != '.git'
+        ]
+        candidates.append(os.path.dirname(current))
+        try:
+            repo_root = get_repo_root(current)
+        except NotARepo:
+            pass
+        else:
+            candidates.extend(
+                fullname for fullname, is_dir in scan_directory(os.path.dirname(repo_root))
+                if is_dir and is_git_repo(fullname)
+            )
+        candidates.extend(recent[1:])
+        result = []
+        for dirname in candidates:
+            if dirname == current or dirname in result or mounts.is_slow(dirname):
+                continue
+            result.append(dirname)
+        return result[:self.MAX_PREFETCH]
+
+    def prefetch_cancelled(self):
+        processes = self.prefetch_budget.processes - self.prefetch_round_start
+        return self.pending or processes >= self.MAX_PREFETCH_GIT
+
+    def reuse_lane_caches(self):
+        """Copy the fast lane's cached results from its last chunk of work into our own
+        caches, other than those for repos whose index or HEAD has changed since. Return
+        the time the lane started that work, which is how old statuses computed from
+        them may be, or None if there were none."""
+        with self.lock:
+            lane_caches = self.lane_caches
+        if lane_caches is None:
+            return None
+        cache_time, caches = lane_caches
+        for func, cache in caches.items():
+            for args, result in cache.items():
+                if func in (repo_root_status, repo_summary):
+                    if git_state_modified_since(args[0], cache_time):
+                        continue
+                func.get_cache()[args] = result
+        return cache_time
+
+    def prefetch_loop(self):
+        """Runs in a low priority thread to compute the statuses of directories the user
+        is likely to view next whilst the worker is otherwise idle, so that they can be
+        shown without waiting for git when they are. Each time the worker finishes some
+        work, we wait until no requests have arrived for PREFETCH_DELAY, then prefetch
+        once, reusing what the fast lane just computed, skipping directories whose
+        prefetched statuses are still valid, and starting at most MAX_PREFETCH_GIT git
+        processes. We stop before the next git command as soon as there are real
+        requests to process."""
+        # On Linux this affects only the current thread, and the git processes it
+        # starts. Their I/O priority is derived from it too:
+        try:
+            os.nice(19)
+        except (AttributeError, OSError):
+            pass
+        use_git_budget(self.prefetch_budget)
+        while True:
+            self.prefetch_required.wait()
+            self.prefetch_required.clear()
+            while self.pending or time.time() - self.last_request_time < self.PREFETCH_DELAY:
+                time.sleep(self.PREFETCH_DELAY)
+            self.prefetch_round_start = self.prefetch_budget.processes
+            prefetch_time = time.time()
+            with self.lock:
+                for dirname, (t, _) in list(self.prefetched.items()):
+                    if prefetch_time - t > self.PREFETCH_LIFETIME:
+                        del self.prefetched[dirname]
+                prefetched = dict(self.prefetched)
+            # Statuses are cached by repo, so each repo's status is computed only once
+            # however many of its directories we prefetch:
+            clear_caches()
+            lane_cache_time = self.reuse_lane_caches()
+            if lane_cache_time is not None:
+                prefetch_time = lane_cache_time
+            try:
+                for dirname in self.get_prefetch_candidates():
+                    if dirname in prefetched and self.prefetch_valid(
+                        dirname, prefetched[dirname][0]
+                    ):
+                        continue
+                    if DEBUG:
+                        print('worker: prefetching:', dirname)
+                    try:
+                        statuses = directory_status(dirname)
+                    except GitCancelled:
+                        raise
+                    except Exception:
+                        # It's only a prefetch. If it's a real problem, it will be
+                        # reported when the directory is viewed:
+                        if DEBUG:
+                            traceback.print_exc()
+                        continue
+                    with self.lock:
+                        self.prefetched[dirname] = prefetch_time, statuses
+            except GitCancelled:
+                # Back off, the user wants something, or we've done enough:
+                pass
 
     def run(self):
         timeout = None
         while True:
             # Block until we get a message. If we get a message with a filepath, set
-            # timeout = self.TIMEOUT so that we can detect when files stop coming. This
-            # way we can batch our processing. Once messages cease, set timeout = None
-            # to block again.
+            # a timeout so that we can detect when files stop coming. This way we can
+            # batch our processing. Once messages cease, set timeout = None to block
+            # again. The timeout is a few times the typical interval between files
+            # arriving in a batch, so that we don't wait longer than needed.
             if self.conn.poll(timeout):
                 try:
                     message = self.conn.recv()
@@ -694,20 +1637,48 @@ class WorkerProcess(object):
                             print('worker sending %d processed files' % len(self.ready))
                         if self.pending:
                             status = STILL_WORKING
+                        elif self.recycle:
+                            status = RECYCLING
                         else:
                             status = ALL_DONE
-                        self.conn.send((self.ready, status))
-                        self.ready = set()
+                        self.conn.send((self.ready, status, self.processed, self.new_roots))
+                        self.ready = {}
+                        self.reported_roots.update(self.new_roots)
+                        self.new_roots = set()
+                    if status == RECYCLING:
+                        # The parent will start a new worker when it next needs one:
+                        return
+                elif message == FORGET:
+                    # The parent has discarded its record of icons, so we should report
+                    # all icons again, even if unchanged:
+                    with self.lock:
+                        self.reported.clear()
+                        self.reported_roots.clear()
+                    self.conn.send(ACK)
                 else:
                     # It's a filepath to be processed, add it to the pile:
+                    lane = self.get_lane(message)
+                    dirname = os.path.dirname(message)
                     with self.lock:
-                        self.pending.add(message)
+                        lane.pending.add(message)
+                        self.recent.pop(dirname, None)
+                        self.recent[dirname] = None
+                        if len(self.recent) > self.MAX_RECENT:
+                            self.recent.popitem(last=False)
+                    now = time.time()
+                    interval = now - self.last_request_time
+                    if interval < self.MAX_TIMEOUT:
+                        # Part of the same batch:
+                        self.mean_interval = 0.8 * self.mean_interval + 0.2 * interval
+                    self.last_request_time = now
                     self.conn.send(ACK)
-                    timeout = self.TIMEOUT
+                    timeout = 3 * self.mean_interval
+                    timeout = min(self.MAX_TIMEOUT, max(self.MIN_TIMEOUT, timeout))
             else:
                 # Timed out. Trigger processing to start and block until the next
                 # message
-                self.processing_required.set()
+                self.fast_lane.processing_required.set()
+                self.slow_lane.processing_required.set()
                 timeout = None
 
 
@@ -716,7 +1687,10 @@ def start_worker_process():
     Python multiprocessing module because a subprocess made via forking will not work in
     the context of the extension with Nautilus running, and we want to retain Python 2
     compatibility for now so can't use the 'spawn' option for a fresh process. So we
-    start a process and set up a connection with it somewhat manually"""
+    start a process and set up a connection with it somewhat manually. This function
+    does not wait for the child to connect, since that would block the file manager
+    whilst the child's interpreter starts up. Returns the listening socket, its address
+    and the child process, to be passed to connect_to_worker() later."""
     sock_addr = os.path.join(
         tempfile.gettempdir(), 'git-nautilus-icons-%s' % hexlify(os.urandom(8)).decode()
     )
@@ -724,13 +1698,27 @@ def start_worker_process():
     sock.bind(sock_addr)
     sock.listen(1)
     child = Popen([sys.executable, __file__, WORKER_ARG, sock_addr])
+    return sock, sock_addr, child
+
+
+def connect_to_worker(sock, sock_addr, timeout):
+    """Called in the parent process to complete the connection with a worker started
+    with start_worker_process(). Returns the connection, or None without blocking if the
+    worker has not connected yet. Raises WorkerUnresponsive if the worker connects but
+    does not complete the handshake within the timeout."""
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return None
     client, _ = sock.accept()
     os.unlink(sock_addr)
     sock.close()
     conn = Connection(os.dup(client.fileno()) if PY2 else client.detach())
-    assert conn.recv() == 'hello'
+    if not conn.poll(timeout) or conn.recv() != 'hello':
+        conn.close()
+        raise WorkerUnresponsive('no hello from worker')
     conn.send('hello')
-    return conn, child
+    return conn
+
 
 def setup_connection_with_parent():
     """Called in the child process to connect to the parent process"""
@@ -743,15 +1731,372 @@ def setup_connection_with_parent():
     return conn
 
 
-if WORKER_ARG not in sys.argv:
+class TraceRecorder(object):
+    """Records the files the extension is asked about and the icons it gives them to a
+    file, one JSON object per line. Traces from successive sessions are appended to the
+    same file."""
+    def __init__(self, filename):
+        # Line buffered so that the trace is intact if the file manager is killed:
+        self.file = open(filename, 'a', 1)
+
+    def record(self, event, path, icon=None):
+        entry = {'t': round(time.time(), 4), 'event': event, 'path': path}
+        if event == 'icon':
+            entry['icon'] = icon
+        self.file.write(json.dumps(entry) + '\n')
+
+
+def replay_trace(args):
+    """Replay the requests in a trace recorded with TRACE_FILE against a worker running
+    in this process, with the same timing as they were recorded (except that idle
+    periods are shortened to at most MAX_GAP seconds), and report how long
+    each took to be answered and how many git processes were started. Git processes
+    started by prefetching are counted separately, since how many there are depends on
+    how long the worker is idle, and so on the replay speed. If the trace's
+    repos have been copied elsewhere, --map can be used to replay it against the copy.
+    Icons that differ from those recorded are reported too."""
+    import argparse
+    from multiprocessing import Pipe
+    MAX_GAP = 5
+    parser = argparse.ArgumentParser(prog='git-nautilus-icons.py ' + REPLAY_ARG)
+    parser.add_argument('trace', help="trace file recorded with GIT_NAUTILUS_ICONS_TRACE")
+    parser.add_argument('--map', nargs=2, metavar=('OLD', 'NEW'),
+                        help="replace path prefix OLD with NEW, to replay against a copy")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="replay this many times faster than recorded")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print the latency of every request")
+    args = parser.parse_args(args)
+
+    def map_path(path):
+        if args.map is not None:
+            old, new = [prefix.rstrip('/') for prefix in args.map]
+            if (path + '/').startswith(old + '/'):
+                return new + path[len(old):]
+        return path
+
+    # Each worker started, so that we can count the git processes they prefetched with:
+    workers = []
+
+    def start_worker():
+        conn, worker_conn = Pipe()
+        workers.append(WorkerProcess(worker_conn))
+        worker_thread = threading.Thread(target=workers[-1].run)
+        worker_thread.daemon = True
+        worker_thread.start()
+        return conn
+
+    requests = []
+    recorded_icons = {}
+    with open(args.trace) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['event'] == 'request':
+                requests.append((entry['t'], map_path(entry['path'])))
+            elif entry['event'] == 'icon':
+                recorded_icons[map_path(entry['path'])] = entry['icon']
+    # Convert times to seconds since the first request. Several file managers may have
+    # appended to the same trace, so sort first:
+    requests.sort()
+    offset = 0
+    previous_t = requests[0][0] if requests else 0
+    for i, (t, path) in enumerate(requests):
+        offset += min(t - previous_t, MAX_GAP) / args.speed
+        previous_t = t
+        requests[i] = (offset, path)
+
+    load_blacklist()
+    conn = start_worker()
+
+    # Poll the worker as often as the extension does:
+    interval = 0.05
+    # Time each outstanding file was requested:
+    outstanding = {}
+    latencies = []
+    icons = {}
+    start_time = time.time()
+    next_poll = start_time + interval
+    i = 0
+    while i < len(requests) or outstanding:
+        now = time.time()
+        if i < len(requests) and start_time + requests[i][0] <= now:
+            _, path = requests[i]
+            conn.send(path)
+            assert conn.recv() == ACK
+            outstanding.setdefault(path, now)
+            i += 1
+            continue
+        if now >= next_poll:
+            next_poll += interval
+            if outstanding:
+                conn.send(SEND_READY)
+                files, worker_status, _, _ = conn.recv()
+                now = time.time()
+                icons.update(files)
+                done = list(files) if worker_status == STILL_WORKING else list(outstanding)
+                for path in done:
+                    if path in outstanding:
+                        latencies.append((now - outstanding.pop(path), path))
+                if worker_status == RECYCLING:
+                    conn = start_worker()
+            continue
+        if i < len(requests):
+            time.sleep(max(0, min(next_poll, start_time + requests[i][0]) - now))
+        else:
+            time.sleep(max(0, next_poll - now))
+    conn.close()
+
+    if args.verbose:
+        for latency, path in latencies:
+            print('%8.1f ms  %s' % (1000 * latency, path))
+    if latencies:
+        sorted_latencies = sorted(latency for latency, _ in latencies)
+        def percentile(p):
+            return 1000 * sorted_latencies[int(p * (len(sorted_latencies) - 1))]
+        print('requests:        %d' % len(requests))
+        print('latency median:  %.1f ms' % percentile(0.5))
+        print('latency 90%%:     %.1f ms' % percentile(0.9))
+        print('latency max:     %.1f ms' % percentile(1))
+    prefetch_processes = sum(worker.prefetch_budget.processes for worker in workers)
+    print('git processes:   %d' % (git_processes_started - prefetch_processes))
+    print('  + prefetching: %d' % prefetch_processes)
+    differing = [
+        path for path, icon in recorded_icons.items() if icons.get(path, icon) != icon
+    ]
+    print('icons differing: %d' % len(differing))
+    for path in sorted(differing):
+        print('    %s: recorded %s, replayed %s' % (path, recorded_icons[path], icons[path]))
+
+
+if IS_EXTENSION:
     # Only define the extension info provider in the parent class
+    class WorkerClient(object):
+        """The parent process's handle on a single worker process. Starts the worker
+        when first needed, and replaces it if it dies or stops responding."""
+        # How long to wait for any reply from the worker before assuming it has hung:
+        IPC_TIMEOUT = 2
+        # How long to wait for a newly started worker to connect:
+        STARTUP_TIMEOUT = 10
+        # How long the worker may go without finishing any files whilst some are
+        # outstanding before we assume it is stuck. Longer than a git status can
+        # plausibly take on a slow network filesystem:
+        PROGRESS_TIMEOUT = 300
+        # How many times in a row to restart the worker without it making any progress
+        # before giving up on the current batch of files:
+        MAX_RESTARTS = 3
+
+        def __init__(self):
+            # The worker is started the first time we're asked for a file, and we
+            # connect to it asynchronously in self.collect() once it is up:
+            self.conn = None
+            self.child = None
+            self.sock = None
+            self.sock_addr = None
+            self.start_time = None
+            self.restarts = 0
+            # The number of files the worker last said it had processed, and when that
+            # last changed:
+            self.processed = 0
+            self.progress_time = None
+            # Files we have been asked for but have not yet had a final answer about
+            # from the worker. These are resubmitted if the worker is restarted:
+            self.outstanding = set()
+
+        def start(self):
+            self.sock, self.sock_addr, self.child = start_worker_process()
+            self.start_time = time.time()
+            self.processed = 0
+            self.progress_time = self.start_time
+
+        def stop(self):
+            """Close the connection to the worker and kill it if it's still running"""
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+                try:
+                    os.unlink(self.sock_addr)
+                except OSError:
+                    # Already unlinked once the worker connected
+                    pass
+            if self.child is not None:
+                if self.child.poll() is None:
+                    self.child.kill()
+                self.child.wait()
+                self.child = None
+
+        def restart(self):
+            """Replace a dead or hung worker with a new one. Outstanding files will be
+            resubmitted to it once it connects."""
+            self.stop()
+            self.restarts += 1
+            if self.restarts > self.MAX_RESTARTS:
+                sys.stderr.write("git-nautilus-icons: worker keeps failing, giving up\n")
+                self.outstanding.clear()
+                self.restarts = 0
+                return
+            if DEBUG:
+                print("parent: restarting worker")
+            self.start()
+
+        def recv(self):
+            """Receive a message from the worker, raising WorkerUnresponsive rather than
+            blocking the GUI indefinitely if it doesn't reply"""
+            try:
+                if self.conn.poll(self.IPC_TIMEOUT):
+                    return self.conn.recv()
+            except (EOFError, IOError, OSError):
+                pass
+            raise WorkerUnresponsive('no reply from worker')
+
+        def send(self, message):
+            """Send a filepath or FORGET to the worker"""
+            try:
+                self.conn.send(message)
+                if self.recv() != ACK:
+                    raise WorkerUnresponsive('unexpected reply from worker')
+            except (IOError, OSError):
+                raise WorkerUnresponsive('could not send to worker')
+
+        def connect(self):
+            """Connect to a worker that is starting up, and send it all outstanding files.
+            Returns whether the worker is connected."""
+            if self.child.poll() is not None:
+                raise WorkerUnresponsive('worker exited during startup')
+            self.conn = connect_to_worker(self.sock, self.sock_addr, self.IPC_TIMEOUT)
+            if self.conn is None:
+                if time.time() - self.start_time > self.STARTUP_TIMEOUT:
+                    raise WorkerUnresponsive('worker did not connect')
+                return False
+            self.sock = None
+            for filepath in self.outstanding:
+                self.send(filepath)
+            return True
+
+        def submit(self, filepath):
+            """Ask the worker for the icon for a file, starting the worker if necessary.
+            If the worker isn't connected yet, the file will be sent once it is."""
+            if not self.outstanding:
+                # The worker has had no work, so can't have been stuck on it:
+                self.progress_time = time.time()
+            self.outstanding.add(filepath)
+            if self.conn is not None:
+                try:
+                    self.send(filepath)
+                except WorkerUnresponsive:
+                    self.restart()
+            elif self.child is None:
+                self.start()
+
+        def forget(self):
+            """Tell the worker the icons it has reported have been forgotten, so that it
+            reports them again even if unchanged. A worker that isn't connected yet
+            hasn't reported anything."""
+            if self.conn is not None:
+                try:
+                    self.send(FORGET)
+                except WorkerUnresponsive:
+                    self.restart()
+
+        def collect(self):
+            """Get the changes in icons the worker has ready. Returns a dict of
+            filepath: icon, with icon None for files that should have no icon, whether
+            the worker still has more work to do, and a set of repository roots the
+            worker has found."""
+            if self.child is None:
+                # We gave up on a failing worker:
+                return {}, False, set()
+            try:
+                if self.conn is None and not self.connect():
+                    # Worker still starting up, check again next time:
+                    return {}, True, set()
+                self.conn.send(SEND_READY)
+                # print("parent: SEND_READY sent, waiting for response")
+                files, worker_status, processed, roots = self.recv()
+            except (WorkerUnresponsive, IOError, OSError) as e:
+                if DEBUG:
+                    print("parent: worker unresponsive:", e)
+                self.restart()
+                return {}, bool(self.outstanding), set()
+            now = time.time()
+            if processed != self.processed or worker_status != STILL_WORKING:
+                self.processed = processed
+                self.progress_time = now
+                self.restarts = 0
+            elif now - self.progress_time > self.PROGRESS_TIMEOUT:
+                # Replying, but stuck. Perhaps a thread died or git is hung:
+                if DEBUG:
+                    print("parent: worker making no progress")
+                self.restart()
+                return files, bool(self.outstanding), roots
+            if DEBUG:
+                print("parent: got response:", STATUS[worker_status])
+            for filepath in files:
+                self.outstanding.discard(filepath)
+            if worker_status in (ALL_DONE, RECYCLING):
+                # Files whose icon hasn't changed are not sent back, so clear them all now:
+                self.outstanding.clear()
+                if worker_status == RECYCLING:
+                    self.stop()
+                return files, False, roots
+            elif worker_status == STILL_WORKING:
+                return files, True, roots
+            else:
+                raise ValueError(worker_status)
+
     class GitNautilusIcons(GObject.GObject, Nautilus.InfoProvider):
         INTERVAL = 50
+        # Maximum number of directories to remember the worker of, and of repository
+        # roots to remember:
+        MAX_SHARD_ROOTS = 10000
+        # Maximum number of files to remember the icons of:
+        MAX_EMBLEMS = 100000
+
         def __init__(self, *args, **kwargs):
             super(GitNautilusIcons, self).__init__(*args, **kwargs)
             self.timeout_id = None
-            self.conn, self.child = start_worker_process()
-
+            self.workers = [WorkerClient() for _ in range(N_WORKERS)]
+            # The index of the worker each directory we've seen was sent to. A directory
+            # always goes to the same worker, since each worker only reports changes to
+            # icons relative to what it reported before:
+            self.shard_of = {}
+            # Repository roots the workers have found, for sharding by repository:
+            self.repo_roots = set()
+            # The icon the workers last reported for each file, or None if it has none.
+            # The workers only tell us about changes, so this is how we give icons to
+            # files that are unchanged:
+            self.emblems = {}
+            self.trace = TraceRecorder(TRACE_FILE) if TRACE_FILE else None
+
+        def get_shard_root(self, directory):
+            """Return the root of the repository containing a directory, if a worker has
+            told us about it, otherwise the directory itself. This runs in the GUI
+            thread, so is done only with string operations and not by looking for
+            '.git' in the filesystem, which could hang on a network filesystem."""
+            root = directory
+            while root not in self.repo_roots:
+                parent = os.path.dirname(root)
+                if parent == root:
+                    return directory
+                root = parent
+            return root
+
+        def get_worker(self, filepath):
+            """Return the worker responsible for the repository containing a file. All
+            files in the same directory go to the same worker, as is required for the
+            worker to compute their statuses together. Until a worker has found the
+            repository a directory is in, the directory is sharded by its own path."""
+            if len(self.workers) == 1:
+                return self.workers[0]
+            directory = os.path.dirname(filepath)
+            try:
+                index = self.shard_of[directory]
+            except KeyError:
+                index = hash(self.get_shard_root(directory)) % len(self.workers)
+                self.shard_of[directory] = index
+            return self.workers[index]
 
         def invalidate_directory(self, directory):
             """Invalidate Nautilus's file info for all files in the given directory,
@@ -767,41 +2112,72 @@ if WORKER_ARG not in sys.argv:
         def update_file_info(self, file):
             filepath = get_filepath(file)
             if filepath is not None:
-                # Put it in the pipe for the subprocess to deal with, and ensure the
-                # timeout is running to check when the subprocess is done:
-                self.conn.send(filepath)
-                assert self.conn.recv() == ACK
+                if self.trace is not None:
+                    self.trace.record('request', filepath)
+                # Give it the icon we already know about straight away:
+                icon = self.emblems.get(filepath)
+                if icon is not None:
+                    file.add_emblem(icon)
+                # Put it in the pipe for the subprocess to check for changes, and ensure
+                # the timeout is running to check when the subprocess is done:
+                self.get_worker(filepath).submit(filepath)
                 if self.timeout_id is None:
                     self.timeout_id = GObject.timeout_add(self.INTERVAL, self.timeout)
 
         def timeout(self):
             if DEBUG:
                 print("parent: timeout")
-            self.conn.send(SEND_READY)
-            # print("parent: SEND_READY sent, waiting for response")
-            files, worker_status = self.conn.recv()
-            if DEBUG:
-                print("parent: got response:", STATUS[worker_status])
-            for filepath, icon in files:
-                if DEBUG:
-                    print("adding icon for file:", filepath)
-                self.set_icon(filepath, icon)
-            if worker_status == ALL_DONE:
-                GObject.source_remove(self.timeout_id)
+            still_working = False
+            for worker in self.workers:
+                if not worker.outstanding:
+                    continue
+                files, worker_still_working, roots = worker.collect()
+                for filepath, icon in files.items():
+                    self.update_icon(filepath, icon)
+                self.repo_roots.update(roots)
+                still_working = still_working or worker_still_working
+            if (len(self.emblems) > self.MAX_EMBLEMS
+                    or len(self.shard_of) > self.MAX_SHARD_ROOTS
+                    or len(self.repo_roots) > self.MAX_SHARD_ROOTS):
+                # Forgetting which worker each directory went to means it might go to a
+                # different one, so the workers must forget what they've reported too:
+                self.emblems.clear()
+                self.shard_of.clear()
+                self.repo_roots.clear()
+                for worker in self.workers:
+                    worker.forget()
+            if not still_working:
                 self.timeout_id = None
                 return False
-            elif worker_status == STILL_WORKING:
-                return True
-            else:
-                raise ValueError(worker_status)
-
-        def set_icon(self, filepath, icon):
+            return True
+
+        def update_icon(self, filepath, icon):
+            """Record a file's new icon and show it. A file's existing emblem can't be
+            removed, so if it had one, Nautilus is told to ask us for the file's info again
+            instead, and we give it the new icon then."""
+            old_icon = self.emblems.get(filepath)
+            self.emblems[filepath] = icon
+            if self.trace is not None:
+                self.trace.record('icon', filepath, icon)
+            if icon == old_icon:
+                return
             uri = pathlib.Path(filepath).as_uri()
             file = Nautilus.FileInfo.create_for_uri(uri)
-            file.add_emblem(icon)
+            if old_icon is not None:
+                if DEBUG:
+                    print("invalidating icon for file:", filepath)
+                file.invalidate_extension_info()
+            elif icon is not None:
+                if DEBUG:
+                    print("adding icon for file:", filepath)
+                file.add_emblem(icon)
+elif REPLAY_ARG in sys.argv:
+    sys.argv.remove(REPLAY_ARG)
+    replay_trace(sys.argv[1:])
 else:
     # We are in the worker process. Start the worker.
     sys.argv.remove(WORKER_ARG)
+    load_blacklist()
     conn = setup_connection_with_parent()
     worker = WorkerProcess(conn)
     worker.run()
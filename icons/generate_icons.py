@@ -10,7 +10,11 @@
 #####################################################################
 
 import os
+import copy
+import json
 import shutil
+import hashlib
+from multiprocessing import Pool
 import svgutils.transform as sg
 
 unstaged = ['clean', 'modified', 'deleted', 'untracked']
@@ -54,90 +58,210 @@ dotgit_icon = [(None, None, None, dotgit)]
 # Put them all together:
 all_icons = unstaged_icons + staged_icons + unmerged_icons + repo_icons + ahead_icons + dotgit_icon
 
-try:
-    shutil.rmtree('hicolor')
-except FileNotFoundError:
-    pass
-    
-os.system('mkdir -p hicolor/scalable/emblems/')
-for tl, tr, bl, br in all_icons:
-    # create new SVG figure
-    background_image = sg.SVGFigure(32, 32)
+# Record of the hash of the inputs each output was generated from, so that outputs whose
+# inputs haven't changed are not regenerated:
+MANIFEST_FILE = 'hicolor_manifest.json'
+
+
+def icon_name(tl, tr, bl, br):
+    return 'git-' + '-'.join([name for name in (tl, tr, bl, br) if name is not None])
+
+
+def detailed_layers(tl, tr, bl, br):
+    """The sub-icons making up a full-detail icon, as a list of (filename, transform)
+    tuples, bottom layer first"""
+    layers = []
     if bl is not None:
-        bl_file = 'sub_icons/{}-l.svg'.format(bl)
-        bl_image = sg.fromfile(bl_file).getroot()
-        background_image.append(bl_image)
+        layers.append(('sub_icons/{}-l.svg'.format(bl), None))
     if br is not None:
-        br_file = 'sub_icons/{}-r.svg'.format(br)
-        br_image = sg.fromfile(br_file).getroot()
-        background_image.append(br_image)
+        layers.append(('sub_icons/{}-r.svg'.format(br), None))
     if tr is not None:
-        tr_file = 'sub_icons/{}.svg'.format(tr)
-        tr_image = sg.fromfile(tr_file).getroot()
-        background_image.append(tr_image)
+        layers.append(('sub_icons/{}.svg'.format(tr), None))
     if tl is not None:
-        tl_file = 'sub_icons/{}.svg'.format(tl)
-        tl_image = sg.fromfile(tl_file).getroot()
-        background_image.append(tl_image)
-    filename = '-'.join([name for name in (tl, tr, bl, br) if name is not None])
-    filename = 'hicolor/scalable/emblems/git-{}.svg'.format(filename)
-    background_image.save(filename)
+        layers.append(('sub_icons/{}.svg'.format(tl), None))
+    return layers
 
-# Simplified icons for the 16x16 size. Only shows a single icon for the worktree part of
-# the status.
-os.system('mkdir -p hicolor/16x16/emblems/')
-for tl, tr, bl, br in all_icons:
-    # create new SVG figure
-    background_image = sg.SVGFigure(32, 32)
+
+def simplified_layers(br, offset, scale):
+    """The sub-icon for a simplified icon showing only a single icon for the worktree
+    part of the status, enlarged to fill the icon"""
     if 'unmerged' in br:
-        br_file = 'sub_icons/unmerged-simple.svg'
+        filename = 'sub_icons/unmerged-simple.svg'
     else:
-        br_file = 'sub_icons/{}-r.svg'.format(br)
-    br_image = sg.fromfile(br_file).getroot()
-    br_image.moveto(-16, -16, scale=1.5)
-    background_image.append(br_image)
+        filename = 'sub_icons/{}-r.svg'.format(br)
+    return [(filename, (offset, offset, scale))]
+
+
+def tiny_icon(br):
+    """The hand-drawn icon for the 8x8 size, showing only the worktree part of the
+    status"""
+    if 'unmerged' in br:
+        return 'tiny_icons/unmerged.png'
+    return 'tiny_icons/{}.png'.format(br)
+
+
+def get_jobs():
+    """Return a dict mapping each output file to a recipe for making it. A recipe is
+    ('svg', layers), for an SVG composed of the given sub-icon layers, ('copy',
+    filename), for a copy of a file, or ('link', filename), for a relative symlink to
+    another output."""
+    jobs = {}
+    for icon in all_icons:
+        _, _, _, br = icon
+        name = icon_name(*icon)
+        jobs['hicolor/scalable/emblems/{}.svg'.format(name)] = ('svg', detailed_layers(*icon))
+        # Simplified icons for the 16x16 and 8x8@2 sizes:
+        simplified_16 = 'hicolor/16x16/emblems/{}.svg'.format(name)
+        jobs[simplified_16] = ('svg', simplified_layers(br, -16, 1.5))
+        simplified_8_2 = 'hicolor/8x8@2/emblems/{}.svg'.format(name)
+        jobs[simplified_8_2] = ('svg', simplified_layers(br, -32, 2))
+        # Simplified, hand-drawn icons for the 8x8 size:
+        jobs['hicolor/8x8/emblems/{}.png'.format(name)] = ('copy', tiny_icon(br))
+        # Duplicate the 16x16 as 16x16@2, and duplicate the 8x8@2 to make 12x12 and
+        # 12x12@2:
+        jobs['hicolor/16x16@2/emblems/{}.svg'.format(name)] = ('link', simplified_16)
+        jobs['hicolor/12x12/emblems/{}.svg'.format(name)] = ('link', simplified_8_2)
+        jobs['hicolor/12x12@2/emblems/{}.svg'.format(name)] = ('link', simplified_8_2)
+    return deduplicate(jobs)
+
+
+def deduplicate(jobs):
+    """Replace all but the first of each set of outputs that would have identical
+    contents with links to the first. At the small sizes, every icon is one of only a
+    handful of images showing the worktree status, so this leaves only one real file
+    per distinct image. The links are stored as symlinks in the source tree, and
+    setup.py installs them as symlinks too, except from a wheel. Wheels can't contain
+    symlinks, so installing with pip still installs a copy of the image for every
+    name."""
+    def content(filename):
+        kind, arg = jobs[filename]
+        if kind == 'link':
+            return content(arg)
+        return kind, repr(arg)
+
+    canonical = {}
+    deduplicated = {}
+    for filename, recipe in jobs.items():
+        key = content(filename)
+        if key not in canonical:
+            canonical[key] = filename
+            deduplicated[filename] = recipe
+        else:
+            deduplicated[filename] = ('link', canonical[key])
+    return deduplicated
+
+
+def remove_existing(filename):
+    """Remove whatever is at filename, if anything, before writing a new output there.
+    Outputs may previously have been symlinks, and writing to one would instead
+    overwrite the file it points to."""
+    if os.path.lexists(filename):
+        os.unlink(filename)
 
-    filename = '-'.join([name for name in (tl, tr, bl, br) if name is not None])
-    filename = 'hicolor/16x16/emblems/git-{}.svg'.format(filename)
-    background_image.save(filename)
 
+def is_up_to_date(filename, recipe, manifest_hash):
+    """Whether an output was last generated from the same recipe, and is still the
+    right kind of file: a symlink for a link and a regular file otherwise. Links must
+    point to an existing file, which also catches links in a cycle."""
+    if manifest_hash != recipe_hash(recipe) or not os.path.exists(filename):
+        return False
+    return os.path.islink(filename) == (recipe[0] == 'link')
 
-# Simplified icons for the 8x8@2 size. Only shows a single icon for the worktree part of
-# the status.
-os.system('mkdir -p hicolor/8x8@2/emblems/')
-for tl, tr, bl, br in all_icons:
+
+def file_hash(filename, _cache={}):
+    try:
+        return _cache[filename]
+    except KeyError:
+        with open(filename, 'rb') as f:
+            _cache[filename] = hashlib.sha256(f.read()).hexdigest()
+        return _cache[filename]
+
+
+def recipe_hash(recipe):
+    """Hash of a recipe and the contents of all the files it depends on"""
+    kind, arg = recipe
+    h = hashlib.sha256(repr(recipe).encode('utf8'))
+    if kind == 'svg':
+        for filename, _ in arg:
+            h.update(file_hash(filename).encode('utf8'))
+    elif kind == 'copy':
+        h.update(file_hash(arg).encode('utf8'))
+    return h.hexdigest()
+
+
+# Parsed sub-icons, so that each process parses each one only once:
+_sub_icons = {}
+
+
+def load_sub_icon(filename):
+    try:
+        figure = _sub_icons[filename]
+    except KeyError:
+        figure = _sub_icons[filename] = sg.fromfile(filename)
+    # Copy, since appending to a figure and moving modify the elements:
+    return copy.deepcopy(figure).getroot()
+
+
+def compose(job):
+    """Create an SVG icon from its layers of sub-icons. Runs in a worker process."""
+    filename, layers = job
     # create new SVG figure
     background_image = sg.SVGFigure(32, 32)
-    if 'unmerged' in br:
-        br_file = 'sub_icons/unmerged-simple.svg'
-    else:
-        br_file = 'sub_icons/{}-r.svg'.format(br)
-    br_image = sg.fromfile(br_file).getroot()
-    br_image.moveto(-32, -32, scale=2)
-    background_image.append(br_image)
-
-    filename = '-'.join([name for name in (tl, tr, bl, br) if name is not None])
-    filename = 'hicolor/8x8@2/emblems/git-{}.svg'.format(filename)
+    for sub_icon_file, transform in layers:
+        image = load_sub_icon(sub_icon_file)
+        if transform is not None:
+            x, y, scale = transform
+            image.moveto(x, y, scale=scale)
+        background_image.append(image)
+    remove_existing(filename)
     background_image.save(filename)
 
 
-# Simplified, hand-drawn icons for the 8x8 size. Only shows a single icon for the
-# worktree part of the status.
-os.system('mkdir -p hicolor/8x8/emblems/')
-for tl, tr, bl, br in all_icons:
-    if 'unmerged' in br:
-        file = 'tiny_icons/unmerged.png'
-    else:
-        file = 'tiny_icons/{}.png'.format(br)
-
-    filename = '-'.join([name for name in (tl, tr, bl, br) if name is not None])
-    filename = 'hicolor/8x8/emblems/git-{}.png'.format(filename)
-    shutil.copy(file, filename)
-
-# Duplicate the 16x16 as 16x16@2, and duplicate the 8x8@2 to make 12x12 and 12x12@2.
-# This would be better done with symlinks, but we can't include symlinks in Python
-# packages. And if we make them in a post-install function, pip won't know to remove
-# them at uninstall time. So duplication it is.
-shutil.copytree('hicolor/16x16/', 'hicolor/16x16@2/')
-shutil.copytree('hicolor/8x8@2/', 'hicolor/12x12/')
-shutil.copytree('hicolor/8x8@2/', 'hicolor/12x12@2/')
\ No newline at end of file
+def main():
+    jobs = get_jobs()
+    try:
+        with open(MANIFEST_FILE) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    # Remove outputs that are no longer generated:
+    for dirpath, _, filenames in os.walk('hicolor'):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path not in jobs:
+                os.unlink(path)
+                manifest.pop(path, None)
+
+    todo = [filename for filename in sorted(jobs)
+            if not is_up_to_date(filename, jobs[filename], manifest.get(filename))]
+    for dirname in set(os.path.dirname(filename) for filename in todo):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    svg_jobs = [(filename, jobs[filename][1]) for filename in todo if jobs[filename][0] == 'svg']
+    if svg_jobs:
+        pool = Pool()
+        try:
+            pool.map(compose, svg_jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    for filename in todo:
+        kind, source = jobs[filename]
+        if kind == 'copy':
+            remove_existing(filename)
+            shutil.copyfile(source, filename)
+        elif kind == 'link':
+            remove_existing(filename)
+            os.symlink(os.path.relpath(source, os.path.dirname(filename)), filename)
+
+    for filename in todo:
+        manifest[filename] = recipe_hash(jobs[filename])
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    print('generated {} of {} icons'.format(len(todo), len(jobs)))
+
+
+if __name__ == '__main__':
+    main()
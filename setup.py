@@ -1,8 +1,16 @@
 import os
 from setuptools import setup
+from setuptools.command.sdist import sdist
+try:
+    from setuptools.command.install_data import install_data
+except ImportError:
+    # Older setuptools:
+    from distutils.command.install_data import install_data
 import glob
 from collections import defaultdict
 
+# Most of the small-size icons are symlinks to one of a few distinct images in the
+# source tree:
 icons = defaultdict(set)
 for path in glob.iglob('icons/hicolor/*/*/*'):
     subdir, filename = os.path.split(path)
@@ -14,6 +22,43 @@ extensions = {
     'share/nemo-python/extensions': ['git-nautilus-icons.py'],
 }
 
+
+class sdist_with_links(sdist):
+    """Keep symlinks in the source tree as symlinks in source distributions, rather than
+    copies of what they point to, so that installing from an unpacked sdist with
+    install_data_with_links installs them as links too."""
+    def make_release_tree(self, base_dir, files):
+        sdist.make_release_tree(self, base_dir, files)
+        if self.dry_run:
+            return
+        for filename in files:
+            if os.path.islink(filename):
+                release_file = os.path.join(base_dir, filename)
+                os.unlink(release_file)
+                os.symlink(os.readlink(filename), release_file)
+
+
+class install_data_with_links(install_data):
+    """Install data files that are symlinks in the source tree as symlinks, rather than
+    as copies of what they point to. The links are relative and their targets are
+    installed alongside them, so they stay valid. They are recorded as installed files
+    like any other, so uninstalling removes them. Wheels can't contain symlinks, so when
+    a wheel is built from this, the links are copied into it. Since pip always installs
+    via a wheel, even from an sdist, pip installs get copies. Running setup.py install
+    from a git checkout or an unpacked sdist, as distribution packaging does, keeps
+    them as links."""
+    def copy_file(self, infile, outfile, *args, **kwargs):
+        if not os.path.islink(infile):
+            return install_data.copy_file(self, infile, outfile, *args, **kwargs)
+        if os.path.isdir(outfile):
+            outfile = os.path.join(outfile, os.path.basename(infile))
+        if not self.dry_run:
+            if os.path.lexists(outfile):
+                os.unlink(outfile)
+            os.symlink(os.readlink(infile), outfile)
+        return outfile, True
+
+
 setup(
     name='git-nautilus-icons',
     packages=[],
@@ -24,4 +69,5 @@ setup(
     url='https://github.com/chrisjbillington/git-nautilus-icons/',
     license="BSD",
     data_files=list(icons.items()) + list(extensions.items()),
+    cmdclass={'sdist': sdist_with_links, 'install_data': install_data_with_links},
 )